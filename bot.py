@@ -6,6 +6,8 @@ import asyncio
 import logging
 import datetime
 import uuid
+import base64
+import hashlib
 import requests
 from io import BytesIO
 from html import escape  # For HTML escaping in filenames
@@ -26,6 +28,7 @@ DATABASE_URL = os.environ.get('DATABASE_URL', 'bot.db')
 ADMIN_USER_ID = int(os.environ.get('ADMIN_USER_ID', 5559075560))
 PORT = int(os.environ.get('PORT', 5000))
 FORWARD_CHANNEL = os.environ.get('FORWARD_CHANNEL')  # New environment variable for channel
+MAX_DOWNLOAD_ATTEMPTS = int(os.environ.get('MAX_DOWNLOAD_ATTEMPTS', 3))  # Resumes/re-fetches before giving up
 
 # Initialize
 app = Flask(__name__)
@@ -94,6 +97,19 @@ def init_db():
         channel_id INTEGER PRIMARY KEY
     )''')
     
+    # Create uploads table (sha256 doubles as a dedup key)
+    c.execute('''CREATE TABLE IF NOT EXISTS uploads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_id TEXT NOT NULL,
+        user_id INTEGER,
+        original_name TEXT,
+        file_size INTEGER,
+        sha256 TEXT,
+        media_type TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_uploads_sha256 ON uploads (sha256, media_type)")
+    
     conn.commit()
     conn.close()
 
@@ -132,7 +148,22 @@ def get_user(user_id):
         user = db_execute("SELECT * FROM users WHERE user_id = ?", (user_id,), fetchone=True)
     return user
 
-def save_file(file_id, user_id, original_name, file_size):
+def save_file(file_id, user_id, original_name, file_size, sha256=None, media_type=None):
+    db_execute(
+        "INSERT INTO uploads (file_id, user_id, original_name, file_size, sha256, media_type) VALUES (?, ?, ?, ?, ?, ?)",
+        (file_id, user_id, original_name, file_size, sha256, media_type)
+    )
+    increment_uploads()
+
+def get_upload_by_checksum(sha256, media_type, original_name):
+    # Telegram keeps the original file name for a reused file_id, so only reuse same-named uploads
+    return db_execute(
+        "SELECT * FROM uploads WHERE sha256 = ? AND media_type = ? AND original_name = ? ORDER BY id DESC LIMIT 1",
+        (sha256, media_type, original_name),
+        fetchone=True
+    )
+
+def increment_uploads():
     db_execute(
         "UPDATE stats SET uploads = uploads + 1"
     )
@@ -237,6 +268,189 @@ class Progress:
             self.last_update = now
             self.last_speed = current
 
+# ===== VERIFIED DOWNLOAD =====
+class DownloadVerificationError(Exception):
+    """Raised when a download cannot be matched against what the origin advertised."""
+
+# Digest header algorithm tokens (RFC 3230) mapped to hashlib names
+DIGEST_ALGORITHMS = {
+    'md5': 'md5',
+    'sha': 'sha1',
+    'sha-256': 'sha256',
+    'sha-512': 'sha512',
+}
+
+def decode_checksum(algo, value):
+    """Decode a base64 (or hex) checksum header value to hex, or None if it is not a valid digest for algo."""
+    value = value.strip()
+    digest_size = hashlib.new(algo).digest_size
+    if len(value) == digest_size * 2 and re.fullmatch(r'[0-9a-fA-F]+', value):
+        return value.lower()
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except ValueError:
+        return None
+    return raw.hex() if len(raw) == digest_size else None
+
+def parse_expected_checksums(headers):
+    """Collect checksums advertised via Content-MD5/Digest headers as hex strings keyed by hashlib name."""
+    expected = {}
+    
+    candidates = []
+    if headers.get('content-md5'):
+        candidates.append(('md5', headers['content-md5']))
+    for part in headers.get('digest', '').split(','):
+        token, sep, value = part.strip().partition('=')
+        algo = DIGEST_ALGORITHMS.get(token.strip().lower())
+        if sep and algo:
+            candidates.append((algo, value))
+    
+    for algo, value in candidates:
+        checksum = decode_checksum(algo, value)
+        if checksum:
+            expected[algo] = checksum
+        else:
+            logger.warning(f"Ignoring malformed {algo} checksum header: {value}")
+    return expected
+
+def get_validator(headers):
+    """Return a strong ETag or Last-Modified usable with If-Range, or None."""
+    etag = headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('last-modified')
+
+def range_start(response):
+    """Return the first byte offset of a 206 response, or None if it cannot be parsed."""
+    match = re.match(r'bytes (\d+)-', response.headers.get('content-range', ''))
+    return int(match.group(1)) if match else None
+
+def is_retryable(error):
+    """Only transient failures are worth another request; 4xx answers won't change on retry."""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+    ))
+
+async def download_verified(url, filepath, file_size, progress):
+    """Stream url into filepath while hashing each chunk, so no second pass over the file is needed.
+    
+    Short transfers are resumed with a Range/If-Range request; checksum mismatches restart from scratch.
+    Returns the SHA-256 hex digest of the verified file.
+    """
+    downloaded = 0
+    expected_size = None
+    expected = {}
+    hashers = {}
+    validator = None
+    encoded = False
+    failure = "transfer interrupted"
+    last_update = datetime.datetime.now()
+    
+    with open(filepath, 'wb') as f:
+        for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS + 1):
+            # Without a validator a resumed tail could belong to a different version of the file,
+            # and decoded byte counts can't be mapped back to Range offsets of an encoded body
+            if downloaded and (not validator or encoded):
+                logger.warning(f"Cannot safely resume {url}, restarting download")
+                downloaded = 0
+            
+            # Identity encoding keeps the bytes on disk identical to the ones the headers describe
+            headers = {'Accept-Encoding': 'identity'}
+            if downloaded:
+                headers['Range'] = f"bytes={downloaded}-"
+                headers['If-Range'] = validator
+            
+            response = None
+            try:
+                response = requests.get(url, stream=True, timeout=300, headers=headers)
+                
+                if downloaded and response.status_code == 416:
+                    logger.warning(f"Range not satisfiable for {url} (attempt {attempt}), restarting download")
+                    downloaded = 0
+                    continue
+                
+                response.raise_for_status()
+                
+                if downloaded and response.status_code == 206:
+                    if (range_start(response) != downloaded
+                            or get_validator(response.headers) != validator):
+                        logger.warning(f"Resumed range does not match earlier response for {url}, restarting download")
+                        downloaded = 0
+                        continue
+                elif downloaded:
+                    # Full body instead of a range (e.g. If-Range failed): use it as a fresh download
+                    logger.warning(f"Range request not honoured for {url}, restarting download")
+                    downloaded = 0
+                
+                if not downloaded:
+                    f.seek(0)
+                    f.truncate()
+                    expected = parse_expected_checksums(response.headers)
+                    validator = get_validator(response.headers)
+                    content_length = response.headers.get('content-length')
+                    expected_size = int(content_length) if content_length else None
+                    
+                    # Content-Length and Digest describe the encoded body, but iter_content yields decoded bytes
+                    encoded = response.headers.get('content-encoding', 'identity').lower() != 'identity'
+                    if encoded:
+                        logger.warning(f"{url} was sent with Content-Encoding, skipping length and checksum checks")
+                        expected = {}
+                        expected_size = None
+                    hashers = {algo: hashlib.new(algo) for algo in {'sha256', *expected}}
+                
+                for chunk in response.iter_content(chunk_size=8192):
+                    if chunk:
+                        f.write(chunk)
+                        for hasher in hashers.values():
+                            hasher.update(chunk)
+                        downloaded += len(chunk)
+                        
+                        now = datetime.datetime.now()
+                        if (now - last_update).seconds >= 1 or downloaded == expected_size:
+                            # Fall back to the HEAD size for display when the body has no Content-Length
+                            await progress.progress_callback(downloaded, expected_size or file_size)
+                            last_update = now
+            except requests.exceptions.RequestException as e:
+                # Connection failed or dropped mid-stream; whatever was written is still valid for resuming
+                if not is_retryable(e) or attempt == MAX_DOWNLOAD_ATTEMPTS:
+                    raise
+                logger.warning(f"Transfer interrupted at {downloaded} bytes (attempt {attempt}): {str(e)}")
+                failure = "transfer interrupted"
+                continue
+            finally:
+                if response is not None:
+                    response.close()
+            
+            if expected_size and downloaded < expected_size:
+                logger.warning(
+                    f"Short read: got {downloaded} of {expected_size} bytes (attempt {attempt}), re-fetching remainder"
+                )
+                failure = f"short read ({format_size(downloaded)} of {format_size(expected_size)})"
+                continue
+            
+            if expected_size and downloaded > expected_size:
+                logger.warning(f"Got {downloaded} bytes, expected {expected_size} (attempt {attempt}), restarting")
+                failure = f"size mismatch ({format_size(downloaded)} instead of {format_size(expected_size)})"
+                downloaded = 0
+                continue
+            
+            mismatched = [algo for algo, value in expected.items() if hashers[algo].hexdigest() != value]
+            if mismatched:
+                logger.warning(f"Checksum mismatch ({', '.join(mismatched)}) for {url} (attempt {attempt}), restarting")
+                failure = f"checksum mismatch ({', '.join(mismatched)})"
+                downloaded = 0
+                continue
+            
+            return hashers['sha256'].hexdigest()
+    
+    raise DownloadVerificationError(
+        f"Could not verify download after {MAX_DOWNLOAD_ATTEMPTS} attempts: {failure}"
+    )
+
 # Bot handlers
 @bot.on_message(filters.command("start"))
 async def start_command(client: Client, message: Message):
@@ -466,27 +680,19 @@ async def format_choice_callback(client: Client, callback_query: CallbackQuery):
         start_time = datetime.datetime.now()
         progress = Progress(msg, start_time)
         
-        # Download file
-        response = requests.get(url, stream=True, timeout=300)
-        response.raise_for_status()
-        
         # Create temporary file
         temp_file = f"downloads/{filename}"
         os.makedirs("downloads", exist_ok=True)
         
-        with open(temp_file, 'wb') as f:
-            downloaded = 0
-            last_update = start_time
-            
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    
-                    now = datetime.datetime.now()
-                    if (now - last_update).seconds >= 1 or downloaded == file_size:
-                        await progress.progress_callback(downloaded, file_size)
-                        last_update = now
+        # Download file, verifying length and checksums as it streams
+        try:
+            checksum = await download_verified(url, temp_file, file_size, progress)
+        except Exception:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+            raise
         
         increment_downloads()
         
@@ -504,7 +710,8 @@ async def format_choice_callback(client: Client, callback_query: CallbackQuery):
             file_size,
             url,  # Pass original URL
             as_video=(format_choice == "video"),
-            thumbnail=thumbnail_file_id
+            thumbnail=thumbnail_file_id,
+            checksum=checksum
         )
         
     except Exception as e:
@@ -521,7 +728,8 @@ async def upload_file(
     file_size,
     original_url,  # Added original URL parameter
     as_video=False,
-    thumbnail=None
+    thumbnail=None,
+    checksum=None
 ):
     msg = await message.edit_text("📤 Uploading file to Telegram...")
     start_time = datetime.datetime.now()
@@ -556,32 +764,56 @@ async def upload_file(
         file_caption = f"@{bot_username} {styled_filename}"
 
         # Determine file type with format choice
-        if as_video and 'video' in content_type:
-            sent_msg = await client.send_video(
-                chat_id=message.chat.id,
-                video=filepath,
-                file_name=filename,
-                caption=file_caption,
-                parse_mode=enums.ParseMode.HTML,
-                progress=progress.progress_callback,
-                supports_streaming=True,
-                thumb=thumbnail_bytes or None
-            )
-            file_id = sent_msg.video.file_id
-        else:
-            sent_msg = await client.send_document(
+        media_type = "video" if as_video and 'video' in content_type else "document"
+        
+        async def send_media(media):
+            if media_type == "video":
+                sent = await client.send_video(
+                    chat_id=message.chat.id,
+                    video=media,
+                    file_name=filename,
+                    caption=file_caption,
+                    parse_mode=enums.ParseMode.HTML,
+                    progress=progress.progress_callback,
+                    supports_streaming=True,
+                    thumb=thumbnail_bytes or None
+                )
+                return sent, sent.video.file_id
+            sent = await client.send_document(
                 chat_id=message.chat.id,
-                document=filepath,
+                document=media,
                 file_name=filename,
                 caption=file_caption,
                 parse_mode=enums.ParseMode.HTML,
                 progress=progress.progress_callback,
                 thumb=thumbnail_bytes or None
             )
-            file_id = sent_msg.document.file_id
+            return sent, sent.document.file_id
+        
+        # Reuse an earlier upload of identical bytes instead of sending them again
+        sent_msg = None
+        if checksum and not thumbnail_bytes:
+            cached = get_upload_by_checksum(checksum, media_type, filename)
+            if cached:
+                try:
+                    sent_msg, file_id = await send_media(cached['file_id'])
+                    logger.info(f"Reused uploaded file {cached['file_id']} for checksum {checksum}")
+                    increment_uploads()
+                except Exception as e:
+                    logger.warning(f"Cached file {cached['file_id']} was rejected, uploading from disk: {str(e)}")
         
-        # Save file reference
-        save_file(file_id, message.from_user.id, filename, file_size)
+        if sent_msg is None:
+            sent_msg, file_id = await send_media(filepath)
+            
+            # Save file reference; uploads carrying a user's thumbnail are kept out of the dedup lookup
+            save_file(
+                file_id,
+                message.from_user.id,
+                filename,
+                file_size,
+                None if thumbnail_bytes else checksum,
+                media_type
+            )
         
         # Forward to channel if configured
         channel_id = get_forward_channel()
@@ -607,7 +839,8 @@ async def upload_file(
             f"✅ **File uploaded successfully!**\n\n"
             f"• **File Name:** `{filename}`\n"
             f"• **File Size:** `{format_size(file_size)}`\n"
-            f"• **Format:** {'Video' if as_video else 'Document'}\n\n"
+            f"• **Format:** {'Video' if as_video else 'Document'}\n"
+            f"• **SHA-256:** `{checksum or 'n/a'}`\n\n"
             f"🔗 Direct Link: `{original_url}`"
         )
         
@@ -0,0 +1,110 @@
+import base64
+import hashlib
+import os
+import sys
+import tempfile
+
+import pytest
+
+# bot.py initialises its database at import time; keep it out of the working tree
+os.environ.setdefault('DATABASE_URL', os.path.join(tempfile.mkdtemp(), 'test.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+requests = pytest.importorskip("requests")
+pytest.importorskip("pyrogram")
+pytest.importorskip("flask")
+
+import bot  # noqa: E402
+
+PAYLOAD = b"hello world"
+MD5 = hashlib.md5(PAYLOAD)
+SHA256 = hashlib.sha256(PAYLOAD)
+
+
+def b64(digest):
+    return base64.b64encode(digest.digest()).decode()
+
+
+def make_response(status_code=200, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+
+def test_decode_checksum_accepts_base64():
+    assert bot.decode_checksum('md5', b64(MD5)) == MD5.hexdigest()
+
+
+def test_decode_checksum_accepts_hex():
+    assert bot.decode_checksum('md5', MD5.hexdigest().upper()) == MD5.hexdigest()
+
+
+def test_decode_checksum_rejects_wrong_length():
+    assert bot.decode_checksum('sha256', b64(MD5)) is None
+    assert bot.decode_checksum('md5', 'abcd') is None
+
+
+def test_decode_checksum_rejects_garbage():
+    assert bot.decode_checksum('md5', 'not base64!') is None
+
+
+def test_parse_expected_checksums_reads_content_md5_and_digest():
+    headers = requests.structures.CaseInsensitiveDict({
+        'Content-MD5': b64(MD5),
+        'Digest': f"SHA-256={b64(SHA256)}, unknown=abc",
+    })
+    assert bot.parse_expected_checksums(headers) == {
+        'md5': MD5.hexdigest(),
+        'sha256': SHA256.hexdigest(),
+    }
+
+
+def test_parse_expected_checksums_skips_malformed_values():
+    headers = requests.structures.CaseInsensitiveDict({
+        'Content-MD5': 'abcd',
+        'Digest': 'sha-256',
+    })
+    assert bot.parse_expected_checksums(headers) == {}
+
+
+def test_parse_expected_checksums_without_headers():
+    assert bot.parse_expected_checksums(requests.structures.CaseInsensitiveDict()) == {}
+
+
+def test_get_validator_prefers_strong_etag():
+    headers = requests.structures.CaseInsensitiveDict({
+        'ETag': '"abc"',
+        'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+    })
+    assert bot.get_validator(headers) == '"abc"'
+
+
+def test_get_validator_ignores_weak_etag():
+    headers = requests.structures.CaseInsensitiveDict({
+        'ETag': 'W/"abc"',
+        'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+    })
+    assert bot.get_validator(headers) == 'Wed, 21 Oct 2015 07:28:00 GMT'
+    assert bot.get_validator(requests.structures.CaseInsensitiveDict({'ETag': 'W/"abc"'})) is None
+
+
+def test_range_start():
+    assert bot.range_start(make_response(206, {'Content-Range': 'bytes 100-199/200'})) == 100
+    assert bot.range_start(make_response(206)) is None
+    assert bot.range_start(make_response(206, {'Content-Range': 'bytes */200'})) is None
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (requests.exceptions.ConnectionError(), True),
+    (requests.exceptions.ConnectTimeout(), True),
+    (requests.exceptions.ReadTimeout(), True),
+    (requests.exceptions.ChunkedEncodingError(), True),
+    (requests.exceptions.HTTPError(response=make_response(503)), True),
+    (requests.exceptions.HTTPError(response=make_response(404)), False),
+    (requests.exceptions.HTTPError(response=make_response(403)), False),
+    (requests.exceptions.HTTPError(), False),
+    (requests.exceptions.InvalidURL(), False),
+])
+def test_is_retryable(error, retryable):
+    assert bot.is_retryable(error) == retryable